@@ -2,15 +2,32 @@
 
 import os
 import yaml
-import json
 import requests
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
 import ipaddress
+import itertools
+import threading
+from bisect import bisect_right
 from hashlib import sha1
-from sys import hexversion
+from hashlib import sha256
 from time import time
+from time import time_ns
 
 import hmac
-import six
+
+# orjson parses large webhook payloads several times
+# faster than the standard library
+try:
+    from orjson import loads as json_loads
+except ImportError:
+    from json import loads as json_loads
+
+# use the libyaml emitter for the queue file when it is compiled in
+try:
+    from yaml import CSafeDumper as YamlDumper
+except ImportError:
+    from yaml import SafeDumper as YamlDumper
 
 from flask import request
 from flask import Flask
@@ -21,6 +38,227 @@ from flask_restful import Api
 app = Flask(__name__)
 api = Api(app)
 
+# the settings are constant for the life of the process,
+# so read them once rather than on every webhook
+GHE_ADDRESS = os.environ.get('GHE_ADDRESS')
+TRIGGER_ID = str(os.environ["TRIGGER_ID"])
+TRIGGER_BRANCH = str(os.environ["TRIGGER_BRANCH"])
+TRIGGER_SECRET = os.environ.get("TRIGGER_SECRET") or None
+# HMAC requires the key to be bytes
+SECRET_BYTES = TRIGGER_SECRET.encode('utf-8') if TRIGGER_SECRET else None
+# pre-keyed HMACs that are copied per webhook to skip the key setup
+# sha256 is preferred, sha1 is kept for legacy X-Hub-Signature posts
+HMAC_TEMPLATES = {}
+if SECRET_BYTES:
+    HMAC_TEMPLATES["sha256"] = hmac.new(SECRET_BYTES,digestmod=sha256)
+    HMAC_TEMPLATES["sha1"] = hmac.new(SECRET_BYTES,digestmod=sha1)
+BUILD_QUEUE_DIR = os.environ.get("FASTEST_CI_QUEUE_DIR","/var/tmp/docker/fastest-ci/queue")
+# numbers the queue files written by the threads of this process
+_QUEUE_FILE_SEQ = itertools.count()
+
+# the acceptable webhook ipaddresses rarely change, so
+# we cache them per provider as (expiry, hook_ranges)
+HOOK_BLOCKS_TTL = int(os.environ.get("HOOK_BLOCKS_TTL",3600))
+_HOOK_BLOCK_CACHE = {}
+
+# the hook blocks are refreshed before the cached entries expire,
+# and retried sooner if a refresh fails
+HOOK_BLOCKS_REFRESH = 0.9*HOOK_BLOCKS_TTL
+HOOK_BLOCKS_RETRY = min(60,HOOK_BLOCKS_REFRESH)
+
+# shared session so cache refreshes reuse the pooled tls connections
+_HTTP = requests.Session()
+_HTTP.mount("https://",HTTPAdapter(pool_connections=4,
+                                   pool_maxsize=4,
+                                   max_retries=Retry(total=2,backoff_factor=0.2)))
+
+def _get_hook_ranges(hook_blocks):
+
+    """Converts the hook blocks into sorted integer address ranges
+
+    Parameters
+    -------
+    hook_blocks - list
+        the hook blocks as ip_network
+
+    Returns
+    -------
+    hook_ranges - dict
+        ip version -> (lows,highs) parallel lists of the merged
+        first and last address of each range, sorted by lows
+    """
+
+    intervals = {4:[],6:[]}
+
+    for block in hook_blocks:
+        intervals[block.version].append((int(block.network_address),
+                                         int(block.broadcast_address)))
+
+    hook_ranges = {}
+
+    for version,_intervals in intervals.items():
+
+        lows = []
+        highs = []
+
+        # merge overlapping blocks so only the range
+        # left of the bisect point needs to be checked
+        for low,high in sorted(_intervals):
+            if highs and low <= highs[-1] + 1:
+                highs[-1] = max(highs[-1],high)
+                continue
+            lows.append(low)
+            highs.append(high)
+
+        hook_ranges[version] = (lows,highs)
+
+    return hook_ranges
+
+def _ip_in_hook_ranges(request_ip,hook_ranges):
+
+    """Checks whether an ipaddress falls in the hook ranges
+
+    Parameters
+    -------
+    request_ip - ip_address
+        the source ipaddress of the webhook
+    hook_ranges - dict
+        the ranges from _get_hook_ranges
+
+    Returns
+    -------
+    boolean
+    """
+
+    lows,highs = hook_ranges[request_ip.version]
+    ip_int = int(request_ip)
+    i = bisect_right(lows,ip_int) - 1
+
+    return i >= 0 and ip_int <= highs[i]
+
+# GHE_ADDRESS is a comma separated allowlist of ipaddresses/blocks
+# e.g. a GHE fleet or egress ranges, parsed once into hook ranges
+if GHE_ADDRESS:
+    GHE_RANGES = _get_hook_ranges([ ipaddress.ip_network(block.strip(),strict=False)
+                                    for block in str(GHE_ADDRESS).split(",") if block.strip() ])
+else:
+    GHE_RANGES = None
+
+def _get_bitbucket_push_fields(payload):
+
+    """normalizes a Bitbucket repo:push payload"""
+
+    change = payload["push"]["changes"][0]
+    commit_info = change["commits"][0]
+    author = commit_info["author"]
+    raw_author = author["raw"]
+
+    if author.get("user"):
+        author_name = author["user"]["display_name"]
+    else:
+        author_name = raw_author
+
+    try:
+        email = raw_author.split("<")[1].split(">")[0].strip()
+    except:
+        email = raw_author
+
+    # Make it more like github, just call it push
+    # and add the committer fields to make it consistent
+    return { "event_type":"push",
+             "commit_hash":commit_info["hash"],
+             "message":commit_info["message"],
+             "author":author_name,
+             "authored_date":commit_info["date"],
+             "committer":author_name,
+             "committed_date":commit_info["date"],
+             "url":commit_info["links"]["html"]["href"],
+             "repo_url":payload["repository"]["links"]["html"]["href"],
+             "compare":change["links"]["html"]["href"],
+             "email":email,
+             "branch":change["new"]["name"] }
+
+def _get_bitbucket_pullrequest_fields(payload):
+
+    """normalizes a Bitbucket pullrequest:created payload"""
+
+    pullrequest = payload["pullrequest"]
+    source = pullrequest["source"]
+    destination = pullrequest["destination"]
+
+    source_hash = source["commit"]["hash"]
+    dest_hash = destination["commit"]["hash"]
+    repo_url = destination["repository"]["links"]["html"]["href"]
+
+    # Branch to commit pull request to
+    dest_branch = destination["branch"]["name"]
+
+    return { "event_type":"pull_request",
+             "commit_hash":source_hash,
+             "dest_branch":dest_branch,
+             "src_branch":source["branch"]["name"],
+             "branch":dest_branch,
+             "message":pullrequest["title"],
+             "author":pullrequest["author"]["display_name"],
+             "url":source["commit"]["links"]["html"]["href"],
+             "created_at":pullrequest["created_on"],
+             "authored_date":pullrequest["created_on"],
+             "updated_at":pullrequest["updated_on"],
+             "committer":None,
+             "committed_date":None,
+             "repo_url":repo_url,
+             #https://bitbucket.org/williaumwu/flask_sample/branches/compare/53cb2d5270c6..917c834ee6a6
+             "compare":"{}/branches/compare/{}..{}".format(repo_url,source_hash,dest_hash) }
+
+def _get_github_push_fields(payload):
+
+    """normalizes a Github push payload"""
+
+    head_commit = payload["head_commit"]
+    author = head_commit["author"]
+
+    return { "event_type":"push",
+             "commit_hash":head_commit["id"],
+             "message":head_commit["message"],
+             "author":author["name"],
+             "authored_date":head_commit["timestamp"],
+             "committer":head_commit["committer"]["name"],
+             "committed_date":head_commit["timestamp"],
+             "url":head_commit["url"],
+             "repo_url":payload["repository"]["html_url"],
+             "compare":payload["compare"],
+             "email":author["email"],
+             "branch":payload["ref"].split("refs/heads/")[1] }
+
+def _get_github_pull_request_fields(payload):
+
+    """normalizes a Github pull_request payload"""
+
+    pull_request = payload["pull_request"]
+    dest_branch = pull_request["base"]["ref"]
+
+    return { "event_type":"pull_request",
+             "commit_hash":pull_request["head"]["sha"],
+             "message":pull_request["body"],
+             "author":pull_request["user"]["login"],
+             "url":pull_request["user"]["url"],
+             "created_at":pull_request["created_at"],
+             "authored_date":pull_request["created_at"],
+             "committer":None,
+             "committed_date":None,
+             "updated_at":pull_request["updated_at"],
+             "dest_branch":dest_branch,
+             "src_branch":pull_request["head"]["ref"],
+             "branch":dest_branch }
+
+# the webhook events we build on, by the provider's event name
+#BITBUCKET_EVENT_HANDLERS["pullrequest:updated"] = _get_bitbucket_pullrequest_fields
+BITBUCKET_EVENT_HANDLERS = { "repo:push":_get_bitbucket_push_fields,
+                             "pullrequest:created":_get_bitbucket_pullrequest_fields }
+
+GITHUB_EVENT_HANDLERS = { "push":_get_github_push_fields,
+                          "pull_request":_get_github_pull_request_fields }
+
 class WebhookProcess(object):
 
     """
@@ -33,6 +271,8 @@ class WebhookProcess(object):
     ----------
     Methods
     -------
+    _detect_provider()
+       returns bitbucket or github from the User-Agent
     _check_secret()
        returns True if webhook secret is correct
     _get_github_hook_blocks()
@@ -45,9 +285,9 @@ class WebhookProcess(object):
        returns True if webhook source ipaddress is valid
     _get_payload_fields()
        returns the payload fields from the webhook
-    _get_bitbucket_payload()
+    _get_bitbucket_payload(payload)
        returns the payload fields from a Bitbucket webhook
-    _get_github_payload()
+    _get_github_payload(payload)
        returns the payload fields from a Github webhook
     _check_trigger_id(trigger_id)
        returns True if trigger id is correct from the http post
@@ -58,15 +298,31 @@ class WebhookProcess(object):
          creates the build yaml, and writes the file queue
     """
 
-    def __init__(self):
+    # the webhook events we build on:
+    #    push
+    #    pull_request
+    events = ( "push", "pull_request" )
 
-        '''
-        the webhook events we build on:
-           push
-           pull_request
-        '''
-  
-        self.events = [ "push", "pull_request" ]
+    # set per request by post()
+    _provider = None
+
+    def _detect_provider(self):
+
+        """Determines the code repository from the User-Agent
+
+        Returns
+        -------
+        provider - str
+            bitbucket or github
+        """
+
+        # User-Agent: Bitbucket-Webhooks/2.0
+        # a prefix check avoids lowercasing the whole header
+        user_agent = request.headers.get('User-Agent','')
+
+        if user_agent.startswith(("Bitbucket","bitbucket")): return "bitbucket"
+
+        return "github"
 
     def _check_secret(self):
 
@@ -82,79 +338,109 @@ class WebhookProcess(object):
             a failed "msg" if check faiils
         """
   
-        header_signature = request.headers.get('X-Hub-Signature')
+        header_signature = request.headers.get('X-Hub-Signature-256')
+        if not header_signature: header_signature = request.headers.get('X-Hub-Signature')
 
         if not header_signature:
             print("WARN: header_signature not provided - no secret check")
             return
-  
-        if self.secret is not None and not isinstance(self.secret,six.binary_type):
-            self.secret = self.secret.encode('utf-8')
+
+        if not HMAC_TEMPLATES:
+            msg = "header_signature provided but TRIGGER_SECRET is not set"
+            return msg
   
         sha_name, signature = header_signature.split('=')
-        if sha_name != 'sha1':
-            msg = "sha_name needs to be sha1"
+        if sha_name not in HMAC_TEMPLATES:
+            msg = "sha_name needs to be sha256 or sha1"
             return msg
   
-        # HMAC requires the key to be bytes, but data is string
-        mac = hmac.new(self.secret, msg=request.data, digestmod=sha1)
+        try:
+            sig_bytes = bytes.fromhex(signature)
+        except ValueError:
+            msg = "signature is not a valid hex digest"
+            return msg
+
+        mac = HMAC_TEMPLATES[sha_name].copy()
+        mac.update(request.data)
   
-        # Python prior to 2.7.7 does not have hmac.compare_digest
-        if hexversion >= 0x020707F0:
-            if not hmac.compare_digest(str(mac.hexdigest()), str(signature)):
-                msg = "Digest does not match signature"
-                return msg
-        else:
-            if not str(mac.hexdigest()) == str(signature):
-                msg = "Digest does not match signature"
-                return msg
+        if not hmac.compare_digest(mac.digest(), sig_bytes):
+            msg = "Digest does not match signature"
+            return msg
   
         return True
 
-    def _get_github_hook_blocks(self):
+    def _get_github_hook_blocks(self,refresh=False):
 
         """Gets the list of hook ipaddresss for Github as the source
+        (cached for HOOK_BLOCKS_TTL seconds)
+
+        Parameters
+        -------
+        refresh - boolean
+            fetches the hook blocks even if they are cached, the
+            cached entry is only replaced if the fetch succeeds
 
         Returns
         -------
         status - boolean
             False - if the check fails
             True  - if the check succeeds
-        results - list
-            the hook blocks for the ipaddresses on Github
+        results - dict
+            the hook ranges for the ipaddresses on Github
         """
 
+        cached = _HOOK_BLOCK_CACHE.get("github")
+        if cached and cached[0] > time() and not refresh: return True,cached[1]
+
+        response = None
+
         try:
-            results = requests.get('https://api.github.com/meta').json()["hooks"]
+            response = _HTTP.get('https://api.github.com/meta',timeout=3).json()
+            results = _get_hook_ranges([ ipaddress.ip_network(block) for block in response["hooks"] ])
             status = True
+            _HOOK_BLOCK_CACHE["github"] = (time()+HOOK_BLOCKS_TTL,results)
         except:
             status = False
             msg_prefix = "Data is missing to check the acceptable ipaddresses"
-            results = "{}\n{}".format(msg_prefix,requests.get('https://api.github.com/meta').json())
+            results = "{}\n{}".format(msg_prefix,response)
             print(results)
 
         return status,results
 
-    def _get_bitbucket_hook_blocks(self):
+    def _get_bitbucket_hook_blocks(self,refresh=False):
 
         """Gets the list of hook ipaddresss for Bitbucket as the source
+        (cached for HOOK_BLOCKS_TTL seconds)
+
+        Parameters
+        -------
+        refresh - boolean
+            fetches the hook blocks even if they are cached, the
+            cached entry is only replaced if the fetch succeeds
 
         Returns
         -------
         status - boolean
             False - if the check fails
             True  - if the check succeeds
-        results - list
-            the hook blocks for the ipaddresses on Bitbucket
+        results - dict
+            the hook ranges for the ipaddresses on Bitbucket
         """
 
+        cached = _HOOK_BLOCK_CACHE.get("bitbucket")
+        if cached and cached[0] > time() and not refresh: return True,cached[1]
+
+        response = None
+
         try:
-            results = [ entry["cidr"] for entry in requests.get('https://ip-ranges.atlassian.com').json()["items"] ]
+            response = _HTTP.get('https://ip-ranges.atlassian.com',timeout=3).json()
+            results = _get_hook_ranges([ ipaddress.ip_network(entry["cidr"]) for entry in response["items"] ])
             status = True
+            _HOOK_BLOCK_CACHE["bitbucket"] = (time()+HOOK_BLOCKS_TTL,results)
         except:
             status = False
             msg_prefix = "Data is missing to check the acceptable ipaddresses"
-            results = "{}\n{}".format(msg_prefix,requests.get('https://ip-ranges.atlassian.com').json())
+            results = "{}\n{}".format(msg_prefix,response)
             print(results)
 
         return status,results
@@ -168,20 +454,18 @@ class WebhookProcess(object):
         status - boolean
             False - if the check fails
             True  - if the check succeeds
-        results - list
-            the hook blocks for the ipaddresses on Bitbucket
+        results - dict
+            the hook ranges for the ipaddresses of the code repository
         provider - str
             bitbucket or github
         """
 
-        user_agent = str(request.headers.get('User-Agent')).lower()
+        provider = self._provider or self._detect_provider()
 
-        if "bitbucket" in user_agent: 
+        if provider == "bitbucket":
             status,results = self._get_bitbucket_hook_blocks()
-            provider = "bitbucket"
         else:
             status,results = self._get_github_hook_blocks()
-            provider = "github"
 
         return provider,status,results
 
@@ -197,24 +481,24 @@ class WebhookProcess(object):
             the failed message
         """
 
-        # Check if the POST request is from github.com/bitbucket
-        if os.environ.get('GHE_ADDRESS'):
-            hook_blocks = [str(os.environ.get('GHE_ADDRESS'))]
-        else:
-            provider,status,hook_blocks = self._get_hook_blocks_by_headers()
-            if status is False: return 'could not determine src ip acceptable "{}" ipaddresses'.format(provider)
+        # the last hop is the address that reached the proxy
+        remote_ip = request.access_route[-1]
+        request_ip = ipaddress.ip_address(remote_ip)
 
-        if len(request.access_route) > 1:
-            remote_ip = request.access_route[-1]
-        else:
-            remote_ip = request.access_route[0]
+        # GHE deployments never need the github.com/bitbucket blocks
+        if GHE_RANGES is not None:
+            if _ip_in_hook_ranges(request_ip,GHE_RANGES):
+                print('request_ip = {} is in the acceptable "GHE" ipaddresses'.format(request_ip))
+                return True
+            return "{} is not in list of accepted src ipaddresses".format(request_ip)
 
-        request_ip = ipaddress.ip_address('{0}'.format(remote_ip))
+        # Check if the POST request is from github.com/bitbucket
+        provider,status,hook_ranges = self._get_hook_blocks_by_headers()
+        if status is False: return 'could not determine src ip acceptable "{}" ipaddresses'.format(provider)
 
-        for block in hook_blocks:
-            if ipaddress.ip_address(request_ip) in ipaddress.ip_network(block):
-                print('request_ip = {} is in the list of acceptable "{}" ipaddresses'.format(request_ip,provider))
-                return True
+        if _ip_in_hook_ranges(request_ip,hook_ranges):
+            print('request_ip = {} is in the list of acceptable "{}" ipaddresses'.format(request_ip,provider))
+            return True
 
         msg = "{} is not in list of accepted src ipaddresses".format(request_ip)
 
@@ -230,19 +514,34 @@ class WebhookProcess(object):
             the normalized payload for the code repository's webhook
         """
 
+        # parse the body once, regardless of the Content-Type
+        try:
+            payload = json_loads(request.get_data(cache=True))
+        except ValueError:
+            payload = None
+
+        if not isinstance(payload,dict):
+            return {"status":False,"failed_msg":"webhook payload is not valid json"}
+
         # Get bitbucket fields
-        # User-Agent: Bitbucket-Webhooks/2.0
-        user_agent = str(request.headers.get('User-Agent')).lower()
-        if "bitbucket" in user_agent:
-            return self._get_bitbucket_payload()
+        provider = self._provider or self._detect_provider()
+        if provider == "bitbucket":
+            return self._get_bitbucket_payload(payload)
 
         # Get github fields
         event_type = request.headers.get('X-GitHub-Event')
-        if event_type: return self._get_github_payload()
+        if event_type: return self._get_github_payload(payload)
 
-    def _get_bitbucket_payload(self):
+        return {"status":False,"failed_msg":"could not determine the webhook provider"}
 
-        """Fetches and transforms the webhook payload for Bitbucket
+    def _get_bitbucket_payload(self,payload):
+
+        """Transforms the webhook payload for Bitbucket
+
+        Parameters
+        -------
+        payload - dict
+            the parsed body of the webhook post
 
         Returns
         -------
@@ -252,89 +551,23 @@ class WebhookProcess(object):
 
         # X-Event-Key: repo:push
         event_type = str(request.headers.get('X-Event-Key'))
-        payload = json.loads(request.data)
-
-        results = {}
-
-        if event_type == "repo:push": 
-
-            # Make it more like github, just call it push
-            event_type = "push"
-
-            commit_info = payload["push"]["changes"][0]["commits"][0]
+        handler = BITBUCKET_EVENT_HANDLERS.get(event_type)
 
-            commit_hash = commit_info["hash"]
-            results["message"] = commit_info["message"]
-
-            if commit_info.get("user"):
-                results["author"] = commit_info["author"]["user"]["display_name"]
-            else:
-                results["author"] = commit_info["author"]["raw"]
-
-            results["authored_date"] = commit_info["date"]
-            # add these fields to make it consistent with Github
-            results["committer"] = results["author"]
-            results["committed_date"] = results["authored_date"]
-
-            results["url"] = commit_info["links"]["html"]["href"]
-            results["repo_url"] = payload["repository"]["links"]["html"]["href"]
-
-            # More fields
-            results["compare"] = payload["push"]["changes"][0]["links"]["html"]["href"]
-
-            try:
-                results["email"] = commit_info["author"]["raw"].split("<")[1].split(">")[0].strip()
-            except:
-                results["email"] = commit_info["author"]["raw"]
-
-            results["branch"] = payload["push"]["changes"][0]["new"]["name"]
-
-        #if event_type in ["pullrequest:created","pullrequest:updated"]:
-        if event_type in ["pullrequest:created"]:
+        # we will provide a message if failed
+        if not handler:
+            failed_msg = "event_type = {} not allowed".format(event_type)
+            return {"status":False,"failed_msg":failed_msg}
 
-            # Make it more like github, just call it push
-            event_type = "pull_request"
+        return handler(payload)
 
-            pullrequest = payload["pullrequest"]
-            source_hash = pullrequest["source"]["commit"]["hash"]
-            dest_hash = pullrequest["destination"]["commit"]["hash"]
+    def _get_github_payload(self,payload):
 
-            # Branch to commit pull request to
-            dest_branch = pullrequest["destination"]["branch"]["name"]
-            src_branch = pullrequest["source"]["branch"]["name"]
-  
-            results["dest_branch"] = dest_branch
-            results["src_branch"] = src_branch
-            results["branch"] = dest_branch
-
-            commit_hash = source_hash
-            results["message"] = pullrequest["title"]
-            results["author"] = pullrequest["author"]["display_name"]
-            results["url"] = pullrequest["source"]["commit"]["links"]["html"]["href"]
-            results["created_at"] = pullrequest["created_on"]
-            results["authored_date"] = pullrequest["created_on"]
-            results["updated_at"] = pullrequest["updated_on"]
-            results["committer"] = None
-            results["committed_date"] = None
-            results["repo_url"] = pullrequest["destination"]["repository"]["links"]["html"]["href"]
-            #https://bitbucket.org/williaumwu/flask_sample/branches/compare/53cb2d5270c6..917c834ee6a6
-            results["compare"] = "{}/branches/compare/{}..{}".format(results["repo_url"],source_hash,dest_hash)
-            #results["email"] = None
-
-        results["event_type"] = event_type
-
-        if event_type == "pull_request" or event_type == "push":
-            results["commit_hash"] = commit_hash
-            return results
+        """Transforms the webhook payload for Github
 
-        # we will provide a message if failed
-        failed_msg = "event_type = {} not allowed".format(event_type)
-        results = {"status":False}
-        results["failed_msg"] = failed_msg
-
-    def _get_github_payload(self):
-
-        """Fetches and transforms the webhook payload for Github
+        Parameters
+        -------
+        payload - dict
+            the parsed body of the webhook post
 
         Returns
         -------
@@ -342,56 +575,14 @@ class WebhookProcess(object):
             the normalized payload for github webhook
         """
 
-        payload = json.loads(request.data)
         event_type = request.headers.get('X-GitHub-Event')
+        handler = GITHUB_EVENT_HANDLERS.get(event_type)
 
-        results = {}
-
-        if event_type == "push": 
-            commit_hash = payload["head_commit"]["id"]
-            results["message"] = payload["head_commit"]["message"]
-            results["author"] = payload["head_commit"]["author"]["name"]
-            results["authored_date"] = payload["head_commit"]["timestamp"]
-            results["committer"] = payload["head_commit"]["committer"]["name"]
-            results["committed_date"] = payload["head_commit"]["timestamp"]
-            results["url"] = payload["head_commit"]["url"]
-            results["repo_url"] = payload["repository"]["html_url"]
-            
-            # More fields
-            results["compare"] = payload["compare"]
-            results["email"] = payload["head_commit"]["author"]["email"]
-
-            results["branch"] = payload["ref"].split("refs/heads/")[1]
-
-        if event_type == "pull_request": 
-            commit_hash = payload["pull_request"]["head"]["sha"]
-            results["message"] = payload["pull_request"]["body"]
-            results["author"] = payload["pull_request"]["user"]["login"]
-            results["url"] = payload["pull_request"]["user"]["url"]
-            results["created_at"] = payload["pull_request"]["created_at"]
-            results["authored_date"] = payload["pull_request"]["created_at"]
-            results["committer"] = None
-            results["committed_date"] = None
-            results["updated_at"] = payload["pull_request"]["updated_at"]
-
-            dest_branch = payload["pull_request"]["base"]["ref"]
-            src_branch = payload["pull_request"]["head"]["ref"]
-
-            results["dest_branch"] = dest_branch
-            results["src_branch"] = src_branch
-            results["branch"] = dest_branch
-
-        results["event_type"] = event_type
-
-        if event_type == "pull_request" or event_type == "push":
-            results["commit_hash"] = commit_hash
-            return results
-
-        failed_msg = "event_type = {} not allowed".format(event_type)
-        results = {"status":False}
-        results["failed_msg"] = failed_msg
-
-        return results
+        if not handler:
+            failed_msg = "event_type = {} not allowed".format(event_type)
+            return {"status":False,"failed_msg":failed_msg}
+
+        return handler(payload)
 
     def _check_trigger_id(self,trigger_id):
 
@@ -411,7 +602,9 @@ class WebhookProcess(object):
         """
 
         if str(trigger_id) != self.trigger_id:
-            return "trigger id {} doesn't match expected {}".format(str(trigger_id),self.trigger_id)
+            # the caller is not yet verified, so the expected id is not echoed
+            print("trigger id {} does not match".format(str(trigger_id)))
+            return "trigger id does not match"
 
         return True
 
@@ -455,23 +648,28 @@ class WebhookProcess(object):
 
         """
 
-        # Check ipaddress
-        _msg_status = self._check_src_ip()
+        # the trigger_id is in the url and the cheapest check,
+        # so wrong urls are rejected before any other work
+        _msg_status = self._check_trigger_id(kwargs["trigger_id"])
 
         if _msg_status is not True: 
             print(_msg_status)
             return {"msg":_msg_status}
 
-        print("source ip checked out ok")
+        print("trigger_id checked out ok")
 
-        _msg_status = self._check_trigger_id(kwargs["trigger_id"])
+        self._provider = self._detect_provider()
+
+        # Check ipaddress
+        _msg_status = self._check_src_ip()
 
         if _msg_status is not True: 
             print(_msg_status)
             return {"msg":_msg_status}
 
-        print("trigger_id checked out ok")
+        print("source ip checked out ok")
 
+        # unsigned or badly signed bodies are rejected before parsing
         _msg_status = self._check_secret()
 
         if _msg_status is True: 
@@ -500,10 +698,25 @@ class WebhookProcess(object):
 
         print("trigger branch checked out ok")
 
-        filepath = os.path.join(self.build_queue_dir,str(int(time())))
+        buf = yaml.dump(payload,Dumper=YamlDumper,default_flow_style=False).encode('utf-8')
 
-        with open(filepath, 'w') as yaml_file:
-            yaml_file.write(yaml.safe_dump(payload,default_flow_style=False))
+        # the nanosecond timestamp keeps the queue ordered, the pid and
+        # a per process counter stop webhooks at the same time (or with
+        # a coarse clock) overwriting each other. the counter moves on
+        # if the name was still taken
+        while True:
+            filepath = os.path.join(self.build_queue_dir,
+                                    "{}-{}-{}.yaml".format(time_ns(),os.getpid(),next(_QUEUE_FILE_SEQ)))
+            try:
+                fd = os.open(filepath,os.O_WRONLY|os.O_CREAT|os.O_EXCL,0o644)
+                break
+            except FileExistsError:
+                continue
+
+        try:
+            os.write(fd,buf)
+        finally:
+            os.close(fd)
 
         # writes the yaml build file that will be 
         # picked up by the build microservice
@@ -513,21 +726,50 @@ class FastestDockerCI(WebhookProcess,Resource):
 
     '''
     the main entrypoint class for the Flask API
+
+    flask-restful creates an instance per request, so the
+    settings are class attributes and there is no __init__
     '''
 
-    def __init__(self):
-  
-        self.events = [ "push", "pull_request" ]
-        self.build_queue_dir = os.environ.get("FASTEST_CI_QUEUE_DIR","/var/tmp/docker/fastest-ci/queue")
-        self.trigger_id = str(os.environ["TRIGGER_ID"])
-        self.trigger_branch = str(os.environ["TRIGGER_BRANCH"])
+    build_queue_dir = BUILD_QUEUE_DIR
+    trigger_id = TRIGGER_ID
+    trigger_branch = TRIGGER_BRANCH
 
-        self.secret = os.environ.get("TRIGGER_SECRET")
-        if self.secret: self.secret = str(self.secret)
+api.add_resource(FastestDockerCI, '/<string:trigger_id>')
 
-        WebhookProcess.__init__(self)
+# WSGI entrypoint for gunicorn - run:application
+application = app
 
-api.add_resource(FastestDockerCI, '/<string:trigger_id>')
+def _refresh_hook_blocks():
+
+    """Best effort fetch of the Github and Bitbucket hook blocks
+    into the cache, rescheduled before the cached entries expire so
+    webhooks do not wait on the fetch
+    """
+
+    webhook = WebhookProcess()
+    refreshed = True
+
+    for provider,get_hook_blocks in (("github",webhook._get_github_hook_blocks),
+                                     ("bitbucket",webhook._get_bitbucket_hook_blocks)):
+        # the cached entry is kept until a fetch succeeds
+        try:
+            status,_ = get_hook_blocks(refresh=True)
+        except Exception as e:
+            status = False
+            print("WARN: could not prewarm {} hook blocks - {}".format(provider,e))
+        refreshed = refreshed and status
+
+    timer = threading.Timer(HOOK_BLOCKS_REFRESH if refreshed else HOOK_BLOCKS_RETRY,
+                            _refresh_hook_blocks)
+    timer.daemon = True
+    timer.start()
+
+# the GHE allowlist does not use the hook blocks
+if not GHE_ADDRESS and HOOK_BLOCKS_TTL > 0:
+    _prewarm = threading.Thread(target=_refresh_hook_blocks,daemon=True)
+    _prewarm.start()
 
 if __name__ == "__main__":
-    app.run(host='0.0.0.0',port=8021,debug=True)
+    # development only - production runs under gunicorn (bin/run.sh)
+    app.run(host='0.0.0.0',port=8021)
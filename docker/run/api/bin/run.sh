@@ -1,8 +1,9 @@
 #!/bin/sh
 
-export THREADS=2
+export WORKERS=${WORKERS:-$(nproc)}
+export THREADS=${THREADS:-4}
 export APP_HOME=/opt/api
 export PATH=/usr/local/sbin:/usr/local/bin:/usr/sbin:/usr/bin:/sbin:/bin:${APP_HOME}/bin:${APP_HOME}/sbin
 export caller="api"
 cd $APP_HOME/bin
-gunicorn -w $THREADS -t 120 -b :8021 --access-logfile - --error-logfile - run:app
+gunicorn -w $WORKERS -k gthread --threads $THREADS -t 120 -b :8021 --access-logfile - --error-logfile - run:application
@@ -1,116 +1,952 @@
 #!/usr/bin/python
 
 import os
-import yaml
+import re
+import fcntl
+import heapq
+import atexit
+import shutil
+import shlex
+import signal
+import socket
+import threading
+import subprocess
+import multiprocessing
+import multiprocessing.connection
+from glob import glob
+from hashlib import sha256
+from hashlib import blake2b
+from collections import OrderedDict
+from collections import deque
+from dataclasses import dataclass
+from functools import wraps
+from concurrent.futures import ThreadPoolExecutor
 from time import sleep
 from time import time
+from time import time_ns
 from edreporthelper.utilities import run_cmds
 from edreporthelper.utilities import git_clone_repo
 
-def build_image(dockerfile="Dockerfile"):
+# inotify wakes the daemon as soon as a build yaml lands in the
+# queue, we fall back to polling without it (e.g. NFS/CIFS)
+try:
+    from inotify_simple import INotify
+    from inotify_simple import flags as inotify_flags
+except ImportError:
+    INotify = None
+
+# parsed build yamls by content hash, so retried
+# (re-enqueued) webhooks skip the parse
+YAML_CACHE_SIZE = 256
+_YAML_CACHE = OrderedDict()
+
+def load_yaml(yaml_bytes):
 
     """
-    wrapper around shellout to build a docker image
+    parses the build yaml, cached by the hash of its content
+
+    Parameters
+    -------
+    yaml_bytes - bytes
+       the contents of the build yaml
+    Returns
+    -------
+    loaded_yaml - dict
+       a copy of the parsed build yaml
+    """
+
+    content_hash = blake2b(yaml_bytes,digest_size=16).digest()
+
+    if content_hash in _YAML_CACHE:
+        _YAML_CACHE.move_to_end(content_hash)
+        return dict(_YAML_CACHE[content_hash])
+
+    # imported on the first build rather than at startup, and
+    # the libyaml parser is used when it is compiled in
+    import yaml
+    yaml_loader = getattr(yaml,"CSafeLoader",yaml.SafeLoader)
+
+    loaded_yaml = dict(yaml.load(yaml_bytes,Loader=yaml_loader))
+
+    _YAML_CACHE[content_hash] = loaded_yaml
+    if len(_YAML_CACHE) > YAML_CACHE_SIZE: _YAML_CACHE.popitem(last=False)
+
+    return dict(loaded_yaml)
+
+@dataclass(frozen=True)
+class BuildContext(object):
+
+    """
+    the values of one build passed explicitly to the build, push
+    and scan rather than through os.environ
+    ...
+    Attributes
+    ----------
+    repo_dir - str
+        the checked out repository, the docker build context
+    repository_uri - str
+        the image repository to push to
+    tag - str
+        the image tag, the short commit hash
+    commit_hash - str
+        the commit being built
+    ecr_login - str
+        the command to log in to the image repository
+    timeout - int
+        seconds before the docker build is killed
+    context_tag - str
+        the ctx-<fingerprint> tag of the build context, or ""
+    build_id - str
+        the name of the build yaml in the queue, it orders the
+        builds and names their log files
+    """
+
+    # no per instance __dict__, dataclass(slots=True) needs python 3.10
+    __slots__ = ( "repo_dir",
+                  "repository_uri",
+                  "tag",
+                  "commit_hash",
+                  "ecr_login",
+                  "timeout",
+                  "context_tag",
+                  "build_id" )
+
+    repo_dir: str
+    repository_uri: str
+    tag: str
+    commit_hash: str
+    ecr_login: str
+    timeout: int
+    context_tag: str
+    build_id: str
+
+# buildx builder used for registry backed layer caching,
+# set by init_buildx() when the daemon starts
+BUILDX_BUILDER = "fastci"
+BUILDX_ENABLED = False
+
+def init_buildx():
+
+    """
+    creates (or reuses) the buildx builder used to share the
+    layer cache through the image registry
+
+    Environment Variable
+    -------
+    DOCKER_BUILDX_CACHE - str
+        set to "false" to use the plain docker build
+
+    Returns
+    -------
+    status - boolean
+       True if builds go through docker buildx
+    """
+
+    global BUILDX_ENABLED
+
+    if os.environ.get("DOCKER_BUILDX_CACHE","true").lower() == "false":
+        BUILDX_ENABLED = False
+        os.environ["DOCKER_BUILDKIT"] = "0"
+        return BUILDX_ENABLED
+
+    cmd = f"docker buildx inspect {BUILDX_BUILDER} || docker buildx create --name {BUILDX_BUILDER} --driver docker-container"
+
+    os.environ["TIMEOUT"] = "300"
+
+    try:
+        results = run_cmds([ cmd ])
+    except:
+        results = {"status":False}
+
+    BUILDX_ENABLED = bool(results.get("status"))
+
+    # BuildKit is only turned on with buildx, docker 23+ fails builds
+    # with BuildKit on and no buildx, so we keep the legacy builder
+    os.environ["DOCKER_BUILDKIT"] = "1" if BUILDX_ENABLED else "0"
+
+    if not BUILDX_ENABLED:
+        print("WARN: docker buildx is not available - building without the registry cache")
+
+    return BUILDX_ENABLED
+
+# docker daemon client reused across builds for the image lookups,
+# tags and pushes, set by init_docker_client() when the daemon starts.
+# docker-py (with requests and urllib3) is imported there rather than
+# with the module, and not at all with DOCKER_PY=false
+DOCKER_CLIENT = None
+docker = None
+DockerTimeout = None
+DOCKER_ERRORS = ()
+
+def init_docker_client():
+
+    """
+    connects the docker-py client to the docker daemon once so the
+    pushes and tags reuse the connection rather than shelling out
+
+    Environment Variable
+    -------
+    DOCKER_PY - str
+        set to "false" to shell out to the docker cli
+
+    Returns
+    -------
+    client - docker.DockerClient
+       the client or None if the docker cli is used
+    """
+
+    global DOCKER_CLIENT,DOCKER_ERRORS,DockerTimeout,docker
+
+    DOCKER_CLIENT = None
+
+    if os.environ.get("DOCKER_PY","true").lower() == "false": return DOCKER_CLIENT
+
+    try:
+        import docker
+        from requests.exceptions import Timeout as DockerTimeout
+    except ImportError:
+        return DOCKER_CLIENT
+
+    DOCKER_ERRORS = ( docker.errors.DockerException, DockerTimeout )
+
+    try:
+        client = docker.from_env(timeout=300)
+        client.ping()
+    except Exception as e:
+        print(f"WARN: docker-py could not connect to the docker daemon - using the docker cli\n{e}")
+        return DOCKER_CLIENT
+
+    DOCKER_CLIENT = client
+
+    return DOCKER_CLIENT
+
+# the full output of the docker build/push and the scan are written
+# to log files, only the last lines are kept in the results
+LOG_DIR = os.environ.get("FASTEST_CI_LOG_DIR","/var/tmp/docker/fastest-ci/logs")
+LOG_TAIL_LINES = 500
+
+# the number of the newest log files kept in LOG_DIR
+LOG_KEEP_FILES = int(os.environ.get("FASTEST_CI_LOG_KEEP",1000))
+
+def prune_logs():
+
+    """
+    removes the oldest log files beyond LOG_KEEP_FILES
+    """
+
+    logs = []
+
+    for entry in os.scandir(LOG_DIR):
+        try:
+            if entry.is_file(): logs.append(( entry.stat().st_mtime, entry.path ))
+        except FileNotFoundError:
+            continue
+
+    if len(logs) <= LOG_KEEP_FILES: return
+
+    logs.sort()
+
+    # another worker may be pruning too
+    for _,path in logs[:len(logs) - LOG_KEEP_FILES]:
+        try:
+            os.unlink(path)
+        except FileNotFoundError:
+            pass
+
+def stream_cmds(cmds,timeout,log_name):
+
+    """
+    runs the shellouts, streaming their output line by line to a
+    log file rather than buffering all of it
+
+    Parameters
+    -------
+    cmds - list
+       the commands to run, stopping on the first failure
+    timeout - int
+       seconds before the commands are killed
+    log_name - str
+       the name of the log file in LOG_DIR
+    Returns
+    -------
+    results - dict
+       status, the tail of the output as the log, the log_file,
+       and timed_out if the commands were killed
+    """
+
+    log_file = f"{LOG_DIR}/{log_name}.log"
+    tail = deque(maxlen=LOG_TAIL_LINES)
+    timed_out = threading.Event()
+
+    # a log that can't be written (e.g. disk full) fails the commands
+    # rather than the daemon
+    try:
+        os.makedirs(LOG_DIR,exist_ok=True)
+        prune_logs()
+        f = open(log_file,"w")
+    except OSError as e:
+        return {"status":False,
+                "log":f"ERROR: could not write {log_file} - {e}",
+                "log_file":log_file,
+                "timed_out":False}
+
+    try:
+        # a new session so the timeout kills the children of the shell too
+        proc = subprocess.Popen(" && ".join(cmds),
+                                shell=True,
+                                stdout=subprocess.PIPE,
+                                stderr=subprocess.STDOUT,
+                                bufsize=1,
+                                universal_newlines=True,
+                                errors="replace",
+                                start_new_session=True)
+    except OSError as e:
+        f.close()
+        return {"status":False,
+                "log":f"ERROR: could not run the commands - {e}",
+                "log_file":log_file,
+                "timed_out":False}
+
+    def _kill():
+        timed_out.set()
+        try:
+            os.killpg(proc.pid,signal.SIGKILL)
+        except ProcessLookupError:
+            pass
+
+    timer = threading.Timer(timeout,_kill)
+    timer.daemon = True
+    timer.start()
+
+    write_error = None
+
+    try:
+        for line in proc.stdout:
+            # the output is still read after a write error so
+            # the commands don't block on the pipe
+            if not write_error:
+                try:
+                    f.write(line)
+                except OSError as e:
+                    write_error = e
+            tail.append(line.rstrip("\n"))
+        proc.wait()
+    finally:
+        timer.cancel()
+        proc.stdout.close()
+        try:
+            f.close()
+        except OSError as e:
+            write_error = write_error or e
+
+    if write_error: tail.append(f"ERROR: could not write {log_file} - {write_error}")
+
+    results = {"status":proc.returncode == 0 and not timed_out.is_set() and not write_error}
+    results["log"] = "\n".join(tail)
+    results["log_file"] = log_file
+    results["timed_out"] = timed_out.is_set()
+
+    return results
+
+def get_ssh_repo_url(repo_url):
+
+    """
+    converts the repository html url from the webhook to the ssh
+    url used with the deploy key
+
+    Parameters
+    -------
+    repo_url - str
+       e.g. https://github.com/<owner>/<repo>
+    Returns
+    -------
+    repo_url - str
+       e.g. git@github.com:<owner>/<repo>.git
+    """
+
+    if not repo_url.startswith(("https://","http://")): return repo_url
+
+    host,path = repo_url.split("://",1)[1].split("/",1)
+    path = path.rstrip("/")
+    if not path.endswith(".git"): path = f"{path}.git"
+
+    return f"git@{host}:{path}"
+
+# the webhook values handed to git, git_clone_repo runs them through
+# a shell so anything outside these characters is refused
+COMMIT_HASH_RE = re.compile(r"[0-9a-fA-F]{7,40}")
+SAFE_GIT_VALUE_RE = re.compile(r"[\w.@:/+%~=-]+")
+
+def is_safe_git_value(value):
+
+    """
+    checks a repository url or branch from the webhook can be
+    passed to git without quoting
+
+    Parameters
+    -------
+    value - str
+       the repository url or branch
+    Returns
+    -------
+    status - boolean
+       True if the value only has safe characters
+    """
+
+    return bool(value) and not value.startswith("-") and bool(SAFE_GIT_VALUE_RE.fullmatch(value))
+
+def shallow_clone_repo(repo_dir,repo_url,commit_hash,branch,key_loc=None,depth=1):
+
+    """
+    runs git to fetch only the commit to build rather than
+    the full history of the repository
 
     Parameters
     -------
+    repo_dir - str
+       the directory to check the commit out in
+    repo_url - str
+       the url of the repository
+    commit_hash - str
+       the commit to check out
+    branch - str
+       the branch fetched if the server does not allow
+       fetching the commit
+    key_loc - str
+       the deploy key used with the ssh url of the repository
+    depth - int
+       the number of commits of history to fetch
+    Returns
+    -------
+    results - dict
+       the results of the clone including the log and status
+    """
+
+    # the values come from the webhook, so git is run without a shell
+    # and the commit must be a hash rather than something git parses
+    if not COMMIT_HASH_RE.fullmatch(commit_hash):
+        return {"status":False,"log":f"ERROR: {commit_hash!r} is not a commit hash"}
+
+    env = dict(os.environ)
+
+    if key_loc and os.path.exists(key_loc):
+        repo_url = get_ssh_repo_url(repo_url)
+        env["GIT_SSH_COMMAND"] = f"ssh -i {shlex.quote(key_loc)} -o StrictHostKeyChecking=no -o BatchMode=yes"
+
+    # fetching a sha needs the server to allow it, otherwise fetch
+    # the branch. a partial (--filter) fetch would not help, the
+    # checkout fetches the missing blobs by hash which the same
+    # server refuses
+    cmds = [ [ "git", "init", "-q" ],
+             [ "git", "remote", "add", "origin", repo_url ],
+             ( [ "git", "fetch", "-q", "--depth", str(depth), "origin", commit_hash ],
+               [ "git", "fetch", "-q", "origin", f"refs/heads/{branch}" ] ),
+             [ "git", "checkout", "-q", commit_hash ] ]
+
+    log = []
+    deadline = time() + 600
+
+    try:
+        # the build dir may be a mount point, so empty it rather than remove it
+        os.makedirs(repo_dir,exist_ok=True)
+        for entry in os.scandir(repo_dir):
+            if entry.is_dir(follow_symlinks=False):
+                shutil.rmtree(entry.path)
+            else:
+                os.unlink(entry.path)
+
+        for cmd in cmds:
+            # a tuple is a command and the fallback if it fails
+            for _cmd in (cmd if isinstance(cmd,tuple) else ( cmd, )):
+                proc = subprocess.run(_cmd,
+                                      cwd=repo_dir,
+                                      env=env,
+                                      stdout=subprocess.PIPE,
+                                      stderr=subprocess.STDOUT,
+                                      universal_newlines=True,
+                                      errors="replace",
+                                      timeout=max(deadline - time(),1))
+                log.append(proc.stdout)
+                if proc.returncode == 0: break
+            if proc.returncode != 0:
+                return {"status":False,"log":"".join(log)}
+    except subprocess.TimeoutExpired:
+        return {"status":False,"log":f"TIMED OUT cloning {repo_url}"}
+    except OSError as e:
+        return {"status":False,"log":f"ERROR: could not clone {repo_url} - {e}"}
+
+    return {"status":True,"log":"".join(log)}
+
+# excluded from the build context when the repository has no .dockerignore,
+# none of these are needed to build the image from a fresh clone
+DEFAULT_DOCKERIGNORE = [ ".git",
+                         "node_modules",
+                         ".venv",
+                         "__pycache__",
+                         "*.pyc",
+                         ".pytest_cache" ]
+
+def write_default_dockerignore(repo_dir):
+
+    """
+    writes DEFAULT_DOCKERIGNORE to the build context if the repository
+    does not have its own .dockerignore, so the daemon is not sent the
+    git history and other cruft
+
+    Environment Variable
+    -------
+    DOCKER_DEFAULT_IGNORE - str
+        set to "false" to never write the .dockerignore
+
+    Parameters
+    -------
+    repo_dir - str
+       the build context directory
+    Returns
+    -------
+    status - boolean
+       True if the .dockerignore was written
+    """
+
+    if os.environ.get("DOCKER_DEFAULT_IGNORE","true").lower() == "false": return False
+
+    dockerignore = f"{repo_dir}/.dockerignore"
+    if os.path.exists(dockerignore): return False
+
+    with open(dockerignore,"w") as f:
+        f.write("\n".join(DEFAULT_DOCKERIGNORE) + "\n")
+
+    return True
+
+def get_build_fingerprint(repo_dir,dockerfile="Dockerfile"):
+
+    """
+    fingerprints the build context from the git tree of the
+    checked out commit and the Dockerfile
+
+    Parameters
+    -------
+    repo_dir - str
+       the checked out repository
     dockerfile - str
        the "Dockerfile" to perform the docker build
     Returns
     -------
+    fingerprint - str
+       the first 16 hex characters of the sha256, None if the
+       git tree could not be read
+    """
+
+    # the tree lists the blob hash of every tracked file so
+    # it changes whenever any content in the context changes
+    try:
+        tree = subprocess.run([ "git", "-C", repo_dir, "ls-tree", "-r", "HEAD" ],
+                              stdout=subprocess.PIPE,
+                              stderr=subprocess.DEVNULL,
+                              check=True,
+                              timeout=60).stdout
+    except (OSError,subprocess.SubprocessError):
+        return
+
+    fingerprint = sha256(tree)
+    fingerprint.update(dockerfile.encode("utf-8"))
+
+    dockerfile_path = os.path.join(repo_dir,dockerfile)
+    if os.path.exists(dockerfile_path):
+        with open(dockerfile_path,"rb") as f:
+            fingerprint.update(f.read())
+
+    return fingerprint.hexdigest()[:16]
+
+def tag_cached_image(ctx):
+
+    """
+    wrapper around shellout to tag an image already built from
+    the same build context, pulling it from the registry if
+    it is not local
+
+    Parameters
+    -------
+    ctx - BuildContext
+       the build, tagged from its context_tag image
+    Returns
+    -------
     results - dict
-       the results of the docker build process including
-       the log and status
+       the results of the tag including the log and status
     """
 
-    repo_dir = os.environ["DOCKER_BUILD_DIR"]
-    repository_uri = os.environ["REPOSITORY_URI"]
-    tag = os.environ["COMMIT_HASH"][0:6]
-    cmds = []
-    cmds.append("cd {} && docker build -t {}:{} . -f {}".format(repo_dir,repository_uri,tag,dockerfile))
-    cmds.append("cd {} && docker build -t {}:latest . -f {}".format(repo_dir,repository_uri,dockerfile))
+    repository_uri = ctx.repository_uri
+    tag = ctx.tag
+    cached_image = f"{repository_uri}:{ctx.context_tag}"
+
+    if DOCKER_CLIENT: return _tag_cached_image_with_client(ctx)
 
-    os.environ["TIMEOUT"] = str(os.environ.get("DOCKER_BUILD_TIMEOUT",1800))
+    _cached_image = shlex.quote(cached_image)
+
+    cmd = f"( docker image inspect {_cached_image} > /dev/null 2>&1"
+    cmd += f" || ( docker manifest inspect {_cached_image} > /dev/null 2>&1 && docker pull -q {_cached_image} ) )"
+    cmd += f" && docker tag {_cached_image} {shlex.quote(f'{repository_uri}:{tag}')}"
+
+    os.environ["TIMEOUT"] = "600"
 
     try:
-        results = run_cmds(cmds)
+        results = run_cmds([ cmd ])
     except:
         results = {"status":False}
-        results["log"] = "TIMED OUT building image"
+        results["log"] = f"TIMED OUT tagging {cached_image}"
 
     return results
 
-def scan_image():
+def _tag_cached_image_with_client(ctx):
 
     """
-    wrapper around shellout to scan docker image
+    tags the image built from the same build context through the
+    docker-py client, pulling it from the registry if it is not local
+    """
+
+    repository_uri = ctx.repository_uri
+    context_tag = ctx.context_tag
+    tag = ctx.tag
+    cached_image = f"{repository_uri}:{context_tag}"
+
+    try:
+        try:
+            image = DOCKER_CLIENT.images.get(cached_image)
+        except docker.errors.ImageNotFound:
+            image = DOCKER_CLIENT.images.pull(repository_uri,tag=context_tag)
+        image.tag(repository_uri,tag=tag)
+    except DOCKER_ERRORS as e:
+        return {"status":False,"log":f"could not tag {cached_image}\n{e}"}
+
+    return {"status":True,"log":f"tagged {cached_image} as {repository_uri}:{tag}"}
+
+# the build_id of the image last tagged latest, the builds of
+# the workers finish in any order
+LATEST_BUILD_FILE = f"{os.path.dirname(LOG_DIR)}/latest-build"
+
+def tag_latest(ctx):
 
+    """
+    tags the image of the build as latest unless a build queued
+    after it already has been
+
+    Parameters
+    -------
+    ctx - BuildContext
+       the build
     Returns
     -------
     results - dict
-       the results of the image scan including
+       the results of the tag including the log and status
+    """
+
+    image = f"{ctx.repository_uri}:{ctx.tag}"
+
+    try:
+        with open(LATEST_BUILD_FILE,"a+") as f:
+
+            fcntl.flock(f,fcntl.LOCK_EX)
+            f.seek(0)
+            latest_build_id = f.read().strip()
+
+            if latest_build_id > ctx.build_id:
+                return {"status":True,"log":f"{ctx.repository_uri}:latest is from the newer build {latest_build_id}"}
+
+            if DOCKER_CLIENT:
+                DOCKER_CLIENT.images.get(image).tag(ctx.repository_uri,tag="latest")
+            else:
+                subprocess.run([ "docker", "tag", image, f"{ctx.repository_uri}:latest" ],
+                               stdout=subprocess.PIPE,
+                               stderr=subprocess.STDOUT,
+                               check=True,
+                               timeout=60)
+
+            f.seek(0)
+            f.truncate()
+            f.write(ctx.build_id)
+
+    except (OSError,subprocess.SubprocessError,*DOCKER_ERRORS) as e:
+        return {"status":False,"log":f"could not tag {image} as latest\n{e}"}
+
+    return {"status":True,"log":f"tagged {image} as latest"}
+
+def build_image(ctx,dockerfile="Dockerfile",extra_tags=None,target=None,image_tags=None,export_cache=False):
+
+    """
+    wrapper around shellout to build a docker image
+
+    Parameters
+    -------
+    ctx - BuildContext
+       the build
+    dockerfile - str
+       the "Dockerfile" to perform the docker build
+    extra_tags - list
+       additional tags for the image
+    target - str
+       the stage of a multi-stage Dockerfile to build
+    image_tags - list
+       replaces the default commit hash tag
+    export_cache - boolean
+       exports the layers to the registry cache, only the build
+       of the image itself should so the cache holds its layers
+    Returns
+    -------
+    results - dict
+       the results of the docker build process including
        the log and status
     """
 
-    trivy_exists = None
+    repo_dir = ctx.repo_dir
+    repository_uri = ctx.repository_uri
+    tag = ctx.tag
+
+    if not image_tags: image_tags = [ tag ]
+    # the values are quoted for the shell
+    tags = " ".join([ f"-t {shlex.quote(f'{repository_uri}:{_tag}')}" for _tag in image_tags + (extra_tags or []) ])
+    if target: tags += f" --target {shlex.quote(target)}"
+    dockerfile = shlex.quote(dockerfile)
+
+    # a single build emits all the tags from one pass over the build graph
+    if BUILDX_ENABLED:
+        # the registry is a layer cache shared by all the runners, cache
+        # export errors (e.g. before the first registry login) are ignored.
+        # --load puts the image in the local daemon for docker push
+        cache_ref = shlex.quote(f"{repository_uri}:buildcache")
+        cmd = f"cd {shlex.quote(repo_dir)} && docker buildx build --builder {BUILDX_BUILDER} --load"
+        cmd += f" --cache-from=type=registry,ref={cache_ref}"
+        # a test build would overwrite the cache with only its own
+        # layers, the image build exports it and the builder keeps
+        # the test's layers locally
+        if export_cache:
+            cmd += f" --cache-to=type=registry,ref={cache_ref},mode=max,image-manifest=true,oci-mediatypes=true,ignore-error=true"
+        cmd += f" {tags} -f {dockerfile} ."
+    else:
+        cmd = f"cd {shlex.quote(repo_dir)} && docker build {tags} . -f {dockerfile}"
+
+    cmds = [ cmd ]
+
+    results = stream_cmds(cmds,
+                          ctx.timeout,
+                          f"{ctx.build_id}-build{'-' + target if target else ''}")
+
+    if results["timed_out"]: results["log"] = f"TIMED OUT building image\n{results['log']}"
 
-    #if is_tool("trivy"): trivy_exists = True
+    return results
 
-    if not trivy_exists and os.path.exists("/usr/local/bin/trivy"): 
-        trivy_exists = True
+# trivy server that keeps the vulnerability db loaded between scans
+TRIVY_SERVER = os.environ.get("TRIVY_SERVER","127.0.0.1:4954")
+TRIVY_CACHE_DIR = os.environ.get("TRIVY_CACHE_DIR","/var/cache/trivy")
 
-    if not trivy_exists:
-        msg = "ERROR: Could not retrieve trivy to scan the image"
-        results = {"status":False}
-        results["log"] = msg
-        return results
+# scan errors that mean the trivy server could not be reached
+TRIVY_CONNECTION_ERRORS = ( "dial tcp", "connection refused", "connection reset", "twirp error unavailable" )
 
-    os.environ["TIMEOUT"] = "1800"
+# seconds between restarts of a trivy server that keeps exiting
+TRIVY_RESTART_INTERVAL = 60
 
-    repository_uri = os.environ["REPOSITORY_URI"]
-    tag = os.environ["COMMIT_HASH"][0:6]
-    fqn_image = "{}:{}".format(repository_uri,tag)
+def scan_image(ctx,trivy_server=None):
 
-    cmds = [ "trivy {}".format(fqn_image) ]
+    """
+    wrapper around shellout to scan docker image
 
-    try:
-        results = run_cmds(cmds)
-    except:
-        results = {"status":False}
-        results["log"] = "TIMED OUT scanning {}".format(fqn_image)
+    Parameters
+    -------
+    ctx - BuildContext
+       the build whose image is scanned
+    trivy_server - str
+       the address of the trivy server to scan with, the
+       standalone trivy is used without it
+    Returns
+    -------
+    results - dict
+       the results of the image scan including
+       the log and status
+    """
+
+    tag = ctx.tag
+    fqn_image = f"{ctx.repository_uri}:{tag}"
+
+    results = None
+
+    # the scan runs alongside the push in a thread, so the timeout is
+    # passed to stream_cmds rather than through os.environ["TIMEOUT"]
+    if trivy_server:
+        results = stream_cmds([ f"trivy image --server http://{trivy_server} {shlex.quote(fqn_image)}" ],
+                              1800,
+                              f"{ctx.build_id}-scan")
+
+        # e.g. the server exited or is still loading its db
+        log = results["log"].lower()
+        if not results["status"] and any(error in log for error in TRIVY_CONNECTION_ERRORS):
+            print(f"could not reach the trivy server - scanning {fqn_image} with the standalone trivy")
+            results = None
+
+    if not results:
+        results = stream_cmds([ f"trivy image {shlex.quote(fqn_image)}" ],1800,f"{ctx.build_id}-scan")
+
+    if results["timed_out"]: results["log"] = f"TIMED OUT scanning {fqn_image}\n{results['log']}"
 
     return results
 
-def push_image():
+def push_image(ctx,login=True):
 
     """
     wrapper around shellout to push docker image
 
+    Parameters
+    -------
+    ctx - BuildContext
+       the build whose image is pushed
+    login - boolean
+       runs the ECR_LOGIN command before the push
     Returns
     -------
     results - dict
         results of the pushing the image to repository
     """
 
-    repository_uri = os.environ["REPOSITORY_URI"]
-    ecr_login = os.environ["ECR_LOGIN"]
-    tag = os.environ["COMMIT_HASH"][0:6]
-    print("Pushing image to repository {}, tag = {}".format(repository_uri,tag))
+    repository_uri = ctx.repository_uri
+    tag = ctx.tag
+    print(f"Pushing image to repository {repository_uri}, tag = {tag}")
+
+    tags = [ tag ]
+
+    # lets other runners skip the build of the same context
+    if ctx.context_tag: tags.append(ctx.context_tag)
+
+    if DOCKER_CLIENT: return _push_image_with_client(ctx,tags,login)
+
     cmds = []
-    cmds.append(ecr_login)
-    cmd = "docker push {}:{}".format(repository_uri,tag)
-    cmds.append(cmd)
+    if login: cmds.append(ctx.ecr_login)
+    for _tag in tags: cmds.append(f"docker push {shlex.quote(f'{repository_uri}:{_tag}')}")
 
-    os.environ["TIMEOUT"] = "300"
+    results = stream_cmds(cmds,300,f"{ctx.build_id}-push")
+
+    if results["timed_out"]: results["log"] = f"TIMED OUT pushing image to registry\n{results['log']}"
+
+    return results
+
+def _push_image_with_client(ctx,tags,login):
+
+    """
+    pushes the image tags through the docker-py client, streaming
+    the push status to the log file like stream_cmds
+    """
+
+    repository_uri = ctx.repository_uri
+    log_name = f"{ctx.build_id}-push"
+
+    if login:
+        results = stream_cmds([ ctx.ecr_login ],300,f"{log_name}-login")
+        if not results["status"]: return results
+        # picks up the credentials the login wrote to the docker config
+        DOCKER_CLIENT.api.reload_config()
+
+    log_file = f"{LOG_DIR}/{log_name}.log"
+    tail = deque(maxlen=LOG_TAIL_LINES)
+    status = True
+    timed_out = False
 
     try:
-        results = run_cmds(cmds)
-    except:
-        results = {"status":False}
-        results["log"] = "TIMED OUT pushing image to registry"
+        os.makedirs(LOG_DIR,exist_ok=True)
+        with open(log_file,"w") as f:
+            for _tag in tags:
+                try:
+                    for chunk in DOCKER_CLIENT.api.push(repository_uri,tag=_tag,stream=True,decode=True):
+                        # the per layer progress bars are left out of the log
+                        if chunk.get("progressDetail"): continue
+                        if "error" in chunk:
+                            status = False
+                            line = chunk["error"]
+                        else:
+                            line = " ".join(str(chunk[key]) for key in ("id","status") if chunk.get(key))
+                        if not line: continue
+                        f.write(f"{line}\n")
+                        tail.append(line)
+                except DOCKER_ERRORS as e:
+                    status = False
+                    timed_out = isinstance(e,DockerTimeout)
+                    f.write(f"{e}\n")
+                    tail.append(str(e))
+                if not status: break
+    except OSError as e:
+        status = False
+        tail.append(f"ERROR: could not write {log_file} - {e}")
+
+    results = {"status":status}
+    results["log"] = "\n".join(tail)
+    results["log_file"] = log_file
+    results["timed_out"] = timed_out
+
+    if timed_out: results["log"] = f"TIMED OUT pushing image to registry\n{results['log']}"
 
     return results
 
+def stage(role,description,succeeded_msg,failed_msg):
+
+    """
+    decorator for the LocalDockerCI stages that keeps the stage's
+    status bookkeeping in one place
+
+    The decorated method returns the results of its shellout,
+    a dict with the boolean "status", the "log" and optionally a
+    "human_description", or a tuple of that dict followed by
+    other values which are passed through
+
+    Parameters
+    -------
+    role - str
+       the role of the stage e.g. docker/build
+    description - str
+       the default human description of the stage
+    succeeded_msg - str
+       the log if the stage succeeded without one
+    failed_msg - str
+       the log if the stage failed without one
+    Returns
+    -------
+    decorator - function
+       wraps the stage to return the stage results dict with the
+       start_time of the build, the offset_ms of the stage from
+       it, human_description, role, status and log
+    """
+
+    def decorator(method):
+
+        @wraps(method)
+        def wrapper(self,*args,**kwargs):
+
+            results = {"start_time":f"{self._start_epoch}",
+                       "offset_ms":time_ns() // 1_000_000 - self._start_ms,
+                       "role":role,
+                       "human_description":description}
+
+            _results = method(self,*args,**kwargs)
+            extra = ()
+            if isinstance(_results,tuple): _results,*extra = _results
+
+            status = bool(_results.get("status"))
+            if _results.get("human_description"): results["human_description"] = _results["human_description"]
+            results["status"] = "completed" if status else "failed"
+            results["log"] = _results.get("log") or (succeeded_msg if status else failed_msg)
+            print(results["log"])
+
+            if extra: return (results,*extra)
+            return results
+
+        return wrapper
+
+    return decorator
+
+# runs of a build yaml whose worker exited before it is dropped
+MAX_BUILD_ATTEMPTS = 2
+
+# ECR tokens last 12 hours, we log in again before they expire
+ECR_LOGIN_TTL = 11*3600
+
+# push errors that mean the registry login has expired
+ECR_AUTH_ERRORS = ( "unauthorized", "denied", "no basic auth credentials" )
+
 class LocalDockerCI(object):
 
     """
@@ -136,13 +972,36 @@ class LocalDockerCI(object):
         a class entry point for building the Docker image
     _push_image()
         a class entry point for pushing the Docker image
+    _scan_image()
+        a class entry point for scanning the Docker image
+    _start_trivy_server()
+        starts the trivy server used by the image scans
+    _check_trivy_server()
+        restarts the trivy server if it has exited
+    _get_build_context(loaded_yaml,build_id)
+        the values of the build passed to its stages
     _run()
         an class method for running a single CI run
+    _run_build(file_path)
+        runs the stages of one build
+    _wait_for_build()
+        blocks until the build queue may have a new build
+    _worker_loop(conn)
+        runs the builds handed over by the daemon in a worker
+    _finish_build(file_path)
+        removes the build yaml a worker is done with
+    _requeue_build(file_path)
+        requeues the build yaml of a worker that exited
+    _run_workers()
+        hands the builds in the queue to the idle workers
     run(loaded_yaml)
         the main class method for running a single CI run
         it is a while loop that keeps on checking the build queue
     """
 
+    # checked once rather than on every scan
+    trivy_exists = os.path.exists("/usr/local/bin/trivy")
+
     def __init__(self):
 
         """
@@ -150,10 +1009,65 @@ class LocalDockerCI(object):
         -------
         FASTEST_CI_QUEUE_DIR - str
             the file location for the filesystem queue
+        DOCKER_BUILDX_CACHE - str
+            "false" disables the buildx registry layer cache
+        DOCKER_PY - str
+            "false" shells out to the docker cli for pushes and tags
+        TRIVY_SERVER - str
+            the address the trivy server listens on, "false"
+            runs the standalone trivy for each scan
+        FASTEST_CI_WORKERS - int
+            the number of builds run at the same time, each in
+            a forked worker process (default 2), 1 runs the
+            builds one at a time in the daemon
         """
   
         self.build_queue_dir = os.environ.get("FASTEST_CI_QUEUE_DIR",
                                               "/var/tmp/docker/fastest-ci/queue")
+        self.workers = int(os.environ.get("FASTEST_CI_WORKERS",2))
+
+        # time of the last ECR_LOGIN, the login is reused across pushes
+        self._ecr_logged_in_at = 0
+
+        # start of the current build, set by _run_build()
+        self._start_ms = time_ns() // 1_000_000
+        self._start_epoch = self._start_ms // 1000
+
+        init_buildx()
+        init_docker_client()
+
+        self._trivy_server = None
+        self._trivy_started_at = 0
+        self._start_trivy_server()
+
+        # heap of queued filenames kept up to date from the inotify
+        # events, names deleted from the queue are dropped from
+        # _queued and skipped when they reach the top of the heap
+        self._pending = []
+        self._queued = set()
+        self._rescan = True
+
+        # names handed to a worker, they stay in the queue until
+        # the worker is done with them, and the times a worker
+        # exited running them
+        self._dispatched = set()
+        self._attempts = {}
+        self._keep_queued = False
+
+        self._inotify = None
+
+        if INotify is None:
+            print(f"WARN: inotify_simple not installed - polling {self.build_queue_dir}")
+            return
+
+        try:
+            self._inotify = INotify()
+            self._inotify.add_watch(self.build_queue_dir,
+                                    inotify_flags.CLOSE_WRITE | inotify_flags.MOVED_TO |
+                                    inotify_flags.DELETE | inotify_flags.MOVED_FROM)
+        except OSError as e:
+            print(f"WARN: could not watch {self.build_queue_dir} - polling - {e}")
+            self._inotify = None
 
     def clear_queue(self):
 
@@ -162,11 +1076,26 @@ class LocalDockerCI(object):
 
         Return
         -------
-            the output from the system shellout
+            the number of entries removed
         """
 
-        print("clearing queue {} on init".format(self.build_queue_dir))
-        return os.system("rm -rf {}/*".format(self.build_queue_dir))
+        print(f"clearing queue {self.build_queue_dir} on init")
+        self._rescan = True
+
+        removed = 0
+
+        for name in os.listdir(self.build_queue_dir):
+            path = f"{self.build_queue_dir}/{name}"
+            try:
+                if os.path.isdir(path) and not os.path.islink(path):
+                    shutil.rmtree(path,ignore_errors=True)
+                else:
+                    os.unlink(path)
+            except FileNotFoundError:
+                continue
+            removed += 1
+
+        return removed
 
     def _get_next_build(self):
 
@@ -179,17 +1108,40 @@ class LocalDockerCI(object):
             the file yaml config for the next build
         """
 
-        filenames = sorted(os.listdir(self.build_queue_dir))
-        if not filenames: return
+        # without inotify events the index can't be trusted
+        if self._rescan or not self._inotify:
+            names = set(os.listdir(self.build_queue_dir))
+            self._dispatched &= names
+            self._queued = names - self._dispatched
+            self._pending = list(self._queued)
+            heapq.heapify(self._pending)
+            self._rescan = False
+
+        filename = None
+
+        while self._pending:
+            name = heapq.heappop(self._pending)
+            if name not in self._queued: continue
+            self._queued.discard(name)
+            # events from before a rescan can name a file already built
+            if not os.path.exists(f"{self.build_queue_dir}/{name}"): continue
+            filename = name
+            break
+
+        if not filename: return
 
-        print('Queue contains {}'.format(filenames))
+        print(f'Queue contains {len(self._queued)} more builds')
 
-        filename = os.path.join(self.build_queue_dir,filenames[0])
+        filename = f"{self.build_queue_dir}/{filename}"
 
-        print('Returning {} to build'.format(filename))
+        print(f'Returning {filename} to build')
 
         return filename
 
+    @stage("github/webhook_read",
+           "loading webhook information",
+           "payload from github webhook loaded and read successfully",
+           "ERROR: could not load yaml - skipping build")
     def _load_webhook(self,file_path):
 
         """
@@ -203,32 +1155,28 @@ class LocalDockerCI(object):
             the values of the build yaml
         """
 
-        results = {"start_time":str(int(time()))}
-        results["human_description"] = "loading webhook information"
-        results["role"] = "github/webhook_read"
-        results["status"] = "in_progress"
-
         try:
-            yaml_str = open(file_path,'r').read()
-            loaded_yaml = dict(yaml.safe_load(yaml_str))
-            msg = "payload from github webhook loaded and read successfully"
-            print(msg)
-            results["status"] = "completed"
+            with open(file_path,'rb') as f:
+                loaded_yaml = load_yaml(f.read())
+            _results = {"status":True}
         except:
             loaded_yaml = None
-            msg = "ERROR: could not load yaml at {} - skipping build".format(file_path)
-            print("-"*32)
-            print(msg)
-            print("-"*32)
-            results["status"] = "failed"
-
-        if not results.get("log"): results["log"] = msg
-        print(results.get("log"))
-
-        os.system("rm -rf {}".format(file_path))
-
-        return results,loaded_yaml
-
+            _results = {"status":False}
+            _results["log"] = f"ERROR: could not load yaml at {file_path} - skipping build"
+
+        # the workers leave the file for the daemon to remove
+        if not self._keep_queued:
+            try:
+                os.unlink(file_path)
+            except FileNotFoundError:
+                pass
+
+        return _results,loaded_yaml
+
+    @stage("git/clone_code",
+           "git pull of code",
+           "cloning code succeeded",
+           "ERROR: cloning code failed")
     def _clone_code(self,loaded_yaml):
 
         """
@@ -250,44 +1198,63 @@ class LocalDockerCI(object):
         branch = loaded_yaml.get("branch")
         if not branch: branch = "master"
 
+        # if pull request, then we should use src branch that
+        # is being pulled in
+        if event_type == "pull_request" and src_branch: branch = src_branch
+
+        for value in ( loaded_yaml["repo_url"], branch ):
+            if not is_safe_git_value(value): return {"status":False,"log":f"ERROR: refusing to clone {value!r}"}
+
+        if not COMMIT_HASH_RE.fullmatch(loaded_yaml["commit_hash"]):
+            return {"status":False,"log":f"ERROR: {loaded_yaml['commit_hash']!r} is not a commit hash"}
+
+        # git_clone_repo reads the repository to clone from os.environ
         os.environ["REPO_KEY_LOC"] = os.environ.get("REPO_KEY_LOC","/var/tmp/docker/files/autogenerated/deploy.pem")
         os.environ["DOCKER_BUILD_DIR"] = os.environ.get("DOCKER_BUILD_DIR","/var/tmp/docker/build")
         os.environ["REPO_URL"] = loaded_yaml["repo_url"]
         os.environ["COMMIT_HASH"] = loaded_yaml["commit_hash"]
 
-        # if push, then we should use branch
         os.environ["REPO_BRANCH"] = branch
 
-        # if pull request, then we should use src branch that 
-        # is being pulled in
-        if event_type == "pull_request" and src_branch:
-            os.environ["REPO_BRANCH"] = src_branch
-
-        results = {"start_time":str(int(time()))}
-        results["human_description"] = "git pull of {} commit {}".format(loaded_yaml["repo_url"],loaded_yaml["commit_hash"])
-        results["role"] = "git/clone_code"
-        results["status"] = "in_progress"
-
-        _cresults = git_clone_repo()
+        # REPO_CLONE_DEPTH=0 clones the full history
+        os.environ["REPO_CLONE_DEPTH"] = str(os.environ.get("REPO_CLONE_DEPTH",1))
+        depth = int(os.environ["REPO_CLONE_DEPTH"])
+
+        if depth > 0:
+            _cresults = shallow_clone_repo(os.environ["DOCKER_BUILD_DIR"],
+                                           os.environ["REPO_URL"],
+                                           os.environ["COMMIT_HASH"],
+                                           os.environ["REPO_BRANCH"],
+                                           key_loc=os.environ["REPO_KEY_LOC"],
+                                           depth=depth)
+            if not _cresults.get("status"):
+                print("WARN: shallow clone failed - cloning the full repository")
+                _cresults = git_clone_repo()
+        else:
+            _cresults = git_clone_repo()
 
-        if _cresults.get("log"): 
-            results["log"] = _cresults["log"]
+        # git_clone_repo only sets the status on failure
+        _cresults["status"] = _cresults.get("status") is not False
+        _cresults["human_description"] = f"git pull of {loaded_yaml['repo_url']} commit {loaded_yaml['commit_hash']}"
 
-        if _cresults.get("status") is False: 
-            msg = "ERROR: cloning code failed"
-            results["status"] = "failed"
-        else:
-            msg = "cloning code succeeded"
-            results["status"] = "completed"
+        if _cresults["status"] and write_default_dockerignore(os.environ["DOCKER_BUILD_DIR"]):
+            print("wrote the default .dockerignore to the build context")
 
-        if not results.get("log"): results["log"] = msg
-        print(results.get("log"))
+        return _cresults
 
-        return results
+    @stage("docker/unit_test",
+           "test of coding",
+           "testing of code succeeded",
+           "ERROR: testing of code failed")
+    def _test_code(self,ctx):
 
-    def _test_code(self):
+        """optional executes code test through Docker, either the
+        DOCKER_TEST_TARGET stage of DOCKER_FILE or DOCKER_FILE_TEST
 
-        """optional executes code test through Docker
+        Parameters
+        -------
+        ctx - BuildContext
+            the build
 
         Return
         -------
@@ -295,118 +1262,231 @@ class LocalDockerCI(object):
             the miscellaneous metadata from testing the code
         """
 
-        results = {"start_time":str(int(time()))}
-        results["human_description"] = "test of coding with {}".format(os.environ["DOCKER_FILE_TEST"])
-        results["role"] = "docker/unit_test"
-        results["status"] = "in_progress"
-        # REPOSITORY_URI This needs to be set for builds
-        _tresults = build_image(os.environ["DOCKER_FILE_TEST"])
-        if _tresults.get("log"): results["log"] = _tresults["log"]
-
-        if _tresults.get("status") is False: 
-            msg = "ERROR: testing of code failed"
-            results["status"] = "failed"
+        test_target = os.environ.get("DOCKER_TEST_TARGET")
+
+        if test_target:
+            # the test is a stage of the main Dockerfile, so the base and
+            # dependency layers are shared with the image build
+            dockerfile = os.environ.get("DOCKER_FILE")
+            if not dockerfile: dockerfile = "Dockerfile"
+            _tresults = build_image(ctx,
+                                    dockerfile,
+                                    target=test_target,
+                                    image_tags=[ f"test-{ctx.tag}" ])
+            _tresults["human_description"] = f"test of coding with {dockerfile} --target {test_target}"
         else:
-            msg = "testing of code succeeded"
-            results["status"] = "completed"
-
-        if not results.get("log"): results["log"] = msg
-        print(results.get("log"))
+            _tresults = build_image(ctx,os.environ["DOCKER_FILE_TEST"])
+            _tresults["human_description"] = f"test of coding with {os.environ['DOCKER_FILE_TEST']}"
 
-        return results
+        return _tresults
 
-    def _build_image(self):
+    @stage("docker/build",
+           "building of image",
+           "building of image succeeded",
+           "building of image failed")
+    def _build_image(self,ctx):
 
         """builds the docker image
 
+        Parameters
+        -------
+        ctx - BuildContext
+            the build
+
         Return
         -------
         results - dict
             the miscellaneous metadata from building image
         """
 
-        results = {"start_time":str(int(time()))}
-        results["human_description"] = "building of image with {}".format(os.environ["DOCKER_FILE"])
-        results["role"] = "docker/build"
-        results["status"] = "in_progress"
-
-        # REPOSITORY_URI This needs to be set for builds
         dockerfile = os.environ.get("DOCKER_FILE")
         if not dockerfile: dockerfile = "Dockerfile"
-        _bresults = build_image(dockerfile)
-        if _bresults.get("log"): results["log"] = _bresults["log"]
 
-        if not _bresults.get("status"):
-            results["status"] = "failed"
-            msg = "building of image failed"
+        description = f"building of image with {dockerfile}"
+
+        # skip the build if the same build context was built before
+        if ctx.context_tag and tag_cached_image(ctx).get("status"):
+            _bresults = {"status":True,
+                         "log":f"cache hit on {ctx.context_tag}, skipped build"}
         else:
-            results["status"] = "completed"
-            msg = "building of image succeeded"
+            _bresults = build_image(ctx,
+                                    dockerfile,
+                                    extra_tags=[ ctx.context_tag ] if ctx.context_tag else None,
+                                    export_cache=True)
+
+        _bresults["human_description"] = description
 
-        if not results.get("log"): results["log"] = msg
-        print(results.get("log"))
+        if _bresults.get("status"): print(tag_latest(ctx)["log"])
 
-        return results
+        return _bresults
 
-    def _push_image(self):
+    @stage("docker/push",
+           "pushing of image",
+           "pushing of image succeeded",
+           "pushing of image failed")
+    def _push_image(self,ctx):
 
         """pushs the docker image to the repo
 
+        Parameters
+        -------
+        ctx - BuildContext
+            the build
+
         Return
         -------
         results - dict
             the miscellaneous metadata from pushing the image
         """
 
-        results = {"start_time":str(int(time()))}
-        results["human_description"] = "pushing of image"
-        results["role"] = "docker/push"
-        results["status"] = "in_progress"
+        login = time() - self._ecr_logged_in_at > ECR_LOGIN_TTL
+        _presults = push_image(ctx,login=login)
 
-        _presults = push_image()
-        if _presults.get("log"): results["log"] = _presults["log"]
-
-        if not _presults.get("status"):
-            msg = "pushing of image failed"
-            results["status"] = "failed"
-        else:
-            msg = "pushing of image succeeded"
-            results["status"] = "completed"
+        # the token was revoked or expired early, log in and retry once
+        if not _presults.get("status") and not login:
+            log = str(_presults.get("log")).lower()
+            if any(error in log for error in ECR_AUTH_ERRORS):
+                print("registry login expired - logging in and retrying the push")
+                login = True
+                _presults = push_image(ctx,login=login)
 
-        if not results.get("log"): results["log"] = msg
-        print(results.get("log"))
+        if login and _presults.get("status"): self._ecr_logged_in_at = time()
 
-        return results
+        return _presults
 
-    def _scan_image(self):
+    @stage("security/scan",
+           "scanning of image",
+           "scanning of image succeeded",
+           "scanning of image failed")
+    def _scan_image(self,ctx):
 
         """scans the container image
 
+        Parameters
+        -------
+        ctx - BuildContext
+            the build
+
         Return
         -------
         results - dict
             the miscellaneous metadata from scanning the image
         """
 
-        results = {"start_time":str(int(time()))}
-        results["human_description"] = "scanning of image"
-        results["role"] = "security/scan"
-        results["status"] = "in_progress"
+        if not self.trivy_exists:
+            msg = "ERROR: Could not retrieve trivy to scan the image"
+            results = {"status":False}
+            results["log"] = msg
+            return results
 
-        _sresults = scan_image()
-        if _sresults.get("log"): results["log"] = _sresults["log"]
+        # the standalone trivy is used if the server has exited
+        trivy_server = TRIVY_SERVER if self._trivy_server_running() else None
 
-        if not _sresults.get("status"):
-            msg = "scanning of image failed"
-            results["status"] = "failed"
-        else:
-            msg = "scanning of image succeeded"
-            results["status"] = "completed"
+        return scan_image(ctx,trivy_server=trivy_server)
+
+    def _start_trivy_server(self):
+
+        """starts the trivy server once for the daemon, so the
+        vulnerability db is loaded once rather than on every scan
+        """
+
+        if not self.trivy_exists or TRIVY_SERVER.lower() == "false": return
+
+        os.makedirs(LOG_DIR,exist_ok=True)
+
+        # registered once, the server may be restarted
+        if not self._trivy_server: atexit.register(self._stop_trivy_server)
+
+        self._trivy_started_at = time()
+
+        with open(f"{LOG_DIR}/trivy-server.log","a") as log:
+            self._trivy_server = subprocess.Popen([ "trivy",
+                                                    "server",
+                                                    "--listen",TRIVY_SERVER,
+                                                    "--cache-dir",TRIVY_CACHE_DIR ],
+                                                  stdout=log,
+                                                  stderr=subprocess.STDOUT)
+
+    def _check_trivy_server(self):
+
+        """reaps the trivy server if it has exited and restarts it,
+        called from the daemon's loop since only the daemon can
+        wait on it
+        """
+
+        if not self._trivy_server or self._trivy_server.poll() is None: return
+
+        if time() - self._trivy_started_at < TRIVY_RESTART_INTERVAL: return
 
-        if not results.get("log"): results["log"] = msg
-        print(results.get("log"))
+        print(f"WARN: trivy server exited with {self._trivy_server.returncode} - restarting it")
+        self._start_trivy_server()
 
-        return results
+    def _trivy_server_running(self):
+
+        """checks the trivy server accepts connections, which works
+        from the workers and fails while the server is still
+        loading its db
+        """
+
+        if not self._trivy_server: return False
+
+        host,port = TRIVY_SERVER.rsplit(":",1)
+
+        try:
+            socket.create_connection((host,int(port)),timeout=1).close()
+        except (OSError,ValueError):
+            return False
+
+        return True
+
+    def _stop_trivy_server(self):
+
+        """terminates the trivy server when the daemon exits
+        """
+
+        if not self._trivy_server or self._trivy_server.poll() is not None: return
+
+        self._trivy_server.terminate()
+
+        try:
+            self._trivy_server.wait(timeout=10)
+        except subprocess.TimeoutExpired:
+            self._trivy_server.kill()
+
+    def _get_build_context(self,loaded_yaml,build_id):
+
+        """the values of the build passed to its stages, read
+        once the code is checked out
+
+        Parameters
+        -------
+        loaded_yaml - dict
+            the values of the build yaml
+        build_id - str
+            the name of the build yaml in the queue
+
+        Return
+        -------
+        ctx - BuildContext
+            the build
+        """
+
+        repo_dir = os.environ["DOCKER_BUILD_DIR"]
+        commit_hash = loaded_yaml["commit_hash"]
+
+        dockerfile = os.environ.get("DOCKER_FILE")
+        if not dockerfile: dockerfile = "Dockerfile"
+
+        fingerprint = get_build_fingerprint(repo_dir,dockerfile)
+
+        return BuildContext(repo_dir=repo_dir,
+                            repository_uri=os.environ["REPOSITORY_URI"],
+                            tag=commit_hash[0:6],
+                            commit_hash=commit_hash,
+                            ecr_login=os.environ["ECR_LOGIN"],
+                            timeout=int(os.environ.get("DOCKER_BUILD_TIMEOUT",1800)),
+                            context_tag=f"ctx-{fingerprint}" if fingerprint else "",
+                            build_id=build_id)
 
     def _run(self):
 
@@ -422,7 +1502,31 @@ class LocalDockerCI(object):
         """
 
         file_path = self._get_next_build()
-        if not file_path: return None,None,None
+        if not file_path: return None,None
+
+        return self._run_build(file_path)
+
+    def _run_build(self,file_path):
+
+        """runs the stages of one build
+
+        Parameters
+        -------
+        file_path - str
+            the build yaml in the queue
+
+        Return
+        -------
+        status - choice
+           successful - if the build run is successful
+           failed - if the build run is failed
+        loaded_yaml - dict
+           the values of the build yaml
+        """
+
+        # the stages record their offset from the start of the build
+        self._start_ms = time_ns() // 1_000_000
+        self._start_epoch = self._start_ms // 1000
 
         # load webhook
         wresults,loaded_yaml = self._load_webhook(file_path)
@@ -432,41 +1536,247 @@ class LocalDockerCI(object):
         cresults = self._clone_code(loaded_yaml)
         if cresults.get("status") == "failed": return cresults.get("status"),loaded_yaml
 
+        ctx = self._get_build_context(loaded_yaml,os.path.basename(file_path).rsplit(".",1)[0])
+        build_dir = ctx.repo_dir
+        test_target = os.environ.get("DOCKER_TEST_TARGET")
+        test_dockerfile = os.environ.get("DOCKER_FILE_TEST")
+
         # test code if necessary
-        if os.environ.get("DOCKER_FILE_TEST") and os.path.exists("{}/{}".format(os.environ["DOCKER_BUILD_DIR"],os.environ["DOCKER_FILE_TEST"])):
-            print('executing Docker test with {}'.format(os.environ["DOCKER_FILE_TEST"]))
-            tresults = self._test_code()
+        if test_target:
+            print(f'executing Docker test with target {test_target}')
+            tresults = self._test_code(ctx)
+            if tresults.get("status") == "failed": return tresults.get("status"),loaded_yaml
+        elif test_dockerfile and os.path.exists(f"{build_dir}/{test_dockerfile}"):
+            print(f'executing Docker test with {test_dockerfile}')
+            tresults = self._test_code(ctx)
             if tresults.get("status") == "failed": return tresults.get("status"),loaded_yaml
 
         # build code
-        bresults = self._build_image()
+        bresults = self._build_image(ctx)
         if bresults.get("status") == "failed": return bresults.get("status"),loaded_yaml
 
-        # push image
-        presults = self._push_image()
-        if presults.get("status") == "failed": return presults.get("status"),loaded_yaml
+        # push and scan image - the scan only needs the local image
+        # so it runs in a thread while the push runs here
+        enable_scan_file = f"{build_dir}/elasticdev/security_scan"
+
+        with ThreadPoolExecutor(max_workers=1) as executor:
 
-        # scan image
-        enable_scan_file = "{}/{}/{}".format(os.environ["DOCKER_BUILD_DIR"],"elasticdev","security_scan")
-        if os.path.exists(enable_scan_file):
-            sresults = self._scan_image()
-            if sresults.get("status") == "failed": return sresults.get("status"),loaded_yaml
+            fut_scan = None
+            if os.path.exists(enable_scan_file):
+                fut_scan = executor.submit(self._scan_image,ctx)
+
+            presults = self._push_image(ctx)
+            sresults = fut_scan.result() if fut_scan else {}
+
+        if presults.get("status") == "failed": return presults.get("status"),loaded_yaml
+        if sresults.get("status") == "failed": return sresults.get("status"),loaded_yaml
 
         return "successful",loaded_yaml
 
+    def _wait_for_build(self,timeout=30000):
+
+        """blocks until a file is written or moved into the build
+        queue and updates the queue index from the inotify events,
+        or sleeps for a second if inotify is not available
+
+        Parameters
+        -------
+        timeout - int
+            milliseconds to wait for the inotify events
+        """
+
+        if not self._inotify: 
+            sleep(1)
+            return
+
+        # we rescan the queue regardless after the timeout
+        events = self._inotify.read(timeout=timeout)
+        if not events: self._rescan = True
+
+        for event in events:
+
+            if event.mask & inotify_flags.Q_OVERFLOW:
+                self._rescan = True
+                continue
+
+            if not event.name: continue
+
+            if event.mask & (inotify_flags.CLOSE_WRITE | inotify_flags.MOVED_TO):
+                if event.name not in self._queued and event.name not in self._dispatched:
+                    self._queued.add(event.name)
+                    heapq.heappush(self._pending,event.name)
+            elif event.mask & (inotify_flags.DELETE | inotify_flags.MOVED_FROM):
+                self._queued.discard(event.name)
+                self._dispatched.discard(event.name)
+
+    def _worker_loop(self,conn):
+
+        """runs the builds handed over by the daemon in a forked
+        worker process, one at a time
+
+        Parameters
+        -------
+        conn - multiprocessing.connection.Connection
+            receives the build yaml to run and sends it back
+            once the build is done
+        """
+
+        # the daemon reads the inotify events, and removes the build
+        # yaml once the build is done so it can be rerun if we exit
+        if self._inotify:
+            self._inotify.close()
+            self._inotify = None
+        self._keep_queued = True
+
+        # each worker clones into a directory of its own
+        build_dir = os.environ.get("DOCKER_BUILD_DIR","/var/tmp/docker/build")
+        os.environ["DOCKER_BUILD_DIR"] = f"{build_dir}/worker-{os.getpid()}"
+
+        # a connection to the docker daemon of its own
+        init_docker_client()
+
+        while True:
+
+            try:
+                file_path = conn.recv()
+            except EOFError:
+                return
+
+            try:
+                status,loaded_yaml = self._run_build(file_path)
+            except Exception as e:
+                print(f"ERROR: build of {file_path} failed - {e}")
+            else:
+                print(f"The webhook info has been loaded and processed. \n{loaded_yaml}")
+
+            conn.send(file_path)
+
+    def _finish_build(self,file_path):
+
+        """removes the build yaml a worker is done with from the queue
+
+        Parameters
+        -------
+        file_path - str
+            the build yaml in the queue
+        """
+
+        name = os.path.basename(file_path)
+
+        try:
+            os.unlink(file_path)
+        except FileNotFoundError:
+            pass
+
+        self._dispatched.discard(name)
+        self._attempts.pop(name,None)
+
+    def _requeue_build(self,file_path):
+
+        """puts the build yaml of a worker that exited back in the
+        queue, unless it has been run MAX_BUILD_ATTEMPTS times
+
+        Parameters
+        -------
+        file_path - str
+            the build yaml in the queue
+        """
+
+        name = os.path.basename(file_path)
+        self._attempts[name] = self._attempts.get(name,0) + 1
+
+        if self._attempts[name] >= MAX_BUILD_ATTEMPTS:
+            print(f"ERROR: worker exited {self._attempts[name]} times running {file_path} - dropping build")
+            self._finish_build(file_path)
+            return
+
+        print(f"WARN: worker exited running {file_path} - requeueing build")
+        self._dispatched.discard(name)
+        self._queued.add(name)
+        heapq.heappush(self._pending,name)
+
+    def _run_workers(self):
+
+        """hands the builds in the queue to the idle forked workers,
+        replacing workers that have exited and requeueing their build
+        """
+
+        mp = multiprocessing.get_context("fork")
+        build_dir = os.environ.get("DOCKER_BUILD_DIR","/var/tmp/docker/build")
+
+        # build dirs left by the workers of an earlier daemon
+        for path in glob(f"{build_dir}/worker-*"): shutil.rmtree(path,ignore_errors=True)
+
+        # worker process -> [ connection, build yaml it is running ]
+        workers = {}
+
+        while True:
+
+            self._check_trivy_server()
+
+            for worker,(conn,file_path) in list(workers.items()):
+                if worker.is_alive(): continue
+                del workers[worker]
+                conn.close()
+                worker.join()
+                shutil.rmtree(f"{build_dir}/worker-{worker.pid}",ignore_errors=True)
+                if file_path: self._requeue_build(file_path)
+
+            while len(workers) < self.workers:
+                conn,worker_conn = mp.Pipe()
+                worker = mp.Process(target=self._worker_loop,args=(worker_conn,),daemon=True)
+                worker.start()
+                worker_conn.close()
+                workers[worker] = [ conn, None ]
+
+            for state in workers.values():
+                if state[1]: continue
+                file_path = self._get_next_build()
+                if not file_path: break
+                self._dispatched.add(os.path.basename(file_path))
+                state[0].send(file_path)
+                state[1] = file_path
+
+            # wait for a worker to finish or exit, or for the queue to change
+            waitables = [ conn for conn,_ in workers.values() ]
+            waitables += [ worker.sentinel for worker in workers ]
+            if self._inotify: waitables.append(self._inotify)
+
+            ready = multiprocessing.connection.wait(waitables,timeout=30 if self._inotify else 1)
+
+            for state in workers.values():
+                if state[0] not in ready: continue
+                try:
+                    self._finish_build(state[0].recv())
+                except EOFError:
+                    # the worker exited, its build is requeued above
+                    continue
+                state[1] = None
+
+            if self._inotify and self._inotify in ready:
+                self._wait_for_build(timeout=0)
+            elif not ready:
+                self._rescan = True
+
     def run(self):
 
-        """main entry point as a daemon to periodically check the filesystem build queue
+        """main entry point as a daemon to check the filesystem build queue
         """
 
+        if self.workers > 1: return self._run_workers()
+
         while True:
 
+            self._check_trivy_server()
+
             status,loaded_yaml = self._run()
 
             if status:
-                print("The webhook info has been loaded and processed. \n{}".format(loaded_yaml))
+                print(f"The webhook info has been loaded and processed. \n{loaded_yaml}")
+                continue
 
-            sleep(1)
+            # queue is drained
+            self._wait_for_build()
 
 if __name__ == "__main__":
 